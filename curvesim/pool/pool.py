@@ -1,11 +1,14 @@
+from contextlib import contextmanager
 from itertools import combinations
 from math import prod
 
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 from gmpy2 import mpz
-from scipy.optimize import least_squares, root_scalar
+from scipy.optimize import brentq, least_squares
+
+# Number of recent D results kept per pool; optimizers and LP operations move
+# back and forth between a handful of balance states.
+_D_CACHE_SIZE = 8
 
 
 class Pool:
@@ -25,10 +28,12 @@ class Pool:
         feemul: fee multiplier for dynamic fee pools
         r: initial redemption price for RAI-like pools
         """
+        self._D_cache = {}
+        self._vp_cache = (None, None)
 
         if isinstance(n, list):  # is metapool
-            self.A = A[0]  # actually A * n ** (n - 1) because it's an invariant
             self.n = n[0]
+            self.A = A[0]  # actually A * n ** (n - 1) because it's an invariant
             self.max_coin = self.n - 1
             if not isinstance(fee, list):
                 fee = [fee] * n[0]
@@ -52,8 +57,7 @@ class Pool:
             if isinstance(D[0], list):
                 self.x = D[0]
             else:
-                rates = self.p[:]
-                rates[self.max_coin] = self.basepool.get_virtual_price()
+                rates = self._rates()
                 self.x = [D[0] // n[0] * 10**18 // _p for _p in rates]
 
             self.ismeta = True
@@ -62,8 +66,8 @@ class Pool:
             self.feemul = feemul
 
         else:
-            self.A = A  # actually A * n ** (n - 1) because it's an invariant
             self.n = n
+            self.A = A  # actually A * n ** (n - 1) because it's an invariant
             self.fee = fee
 
             if p:
@@ -85,8 +89,46 @@ class Pool:
             self.r = False
             self.n_total = self.n
 
-    def xp(self):
-        return [x * p // 10**18 for x, p in zip(self.x, self.p)]
+    @property
+    def A(self):
+        return self._A
+
+    @A.setter
+    def A(self, A):
+        # A-dependent constants used by the invariant and pricing calculations
+        self._A = A
+        self._Ann = A * self.n
+        self._A_pow = A * self.n ** (self.n + 1)
+
+    def _rates(self):
+        """
+        Metapool coin rates, with the basepool's virtual price as the rate of its LP token.
+        """
+        rates = self.p[:]
+        rates[self.max_coin] = self.basepool.get_virtual_price()
+        return rates
+
+    def xp(self, x=None, rates=None):
+        """
+        Balances in 1e18 precision; x and rates default to the pool's balances and precisions.
+        """
+        if x is None:
+            x = self.x
+        if rates is None:
+            rates = self.p
+        return [_x * p // 10**18 for _x, p in zip(x, rates)]
+
+    def _meta_indices(self, i, j):
+        """
+        Maps a metapool's underlying coin indices to basepool indices (base_i, base_j),
+        negative for the metapool's own coins, and metapool indices (meta_i, meta_j),
+        max_coin (the basepool LP token) for basepool coins.
+        """
+        base_i = i - self.max_coin
+        base_j = j - self.max_coin
+        meta_i = i if base_i < 0 else self.max_coin
+        meta_j = j if base_j < 0 else self.max_coin
+        return base_i, base_j, meta_i, meta_j
 
     def D(self, xp=None):
         """
@@ -97,23 +139,23 @@ class Pool:
 
         Converging solution:
         D[j+1] = (A * n**n * sum(x_i) - D[j]**(n+1) / (n**n prod(x_i))) / (A * n**n - 1)
+
+        The last few results are cached, keyed on A and the balances they were
+        computed from, so returning to a recent pool state skips the iteration.
+        Keying on the balances themselves (rather than tracking writes) keeps
+        the cache valid when `x` or `p` are modified in place.
         """
-        Dprev = 0
         if xp is None:
             xp = self.xp()
-        S = sum(xp)
-        D = S
-        Ann = self.A * self.n
-        D = mpz(D)
-        Ann = mpz(Ann)
-        while abs(D - Dprev) > 1:
-            D_P = D
-            for x in xp:
-                D_P = D_P * D // (self.n * x)
-            Dprev = D
-            D = (Ann * S + D_P * self.n) * D // ((Ann - 1) * D + (self.n + 1) * D_P)
-
-        D = int(D)
+
+        key = (self._Ann, *xp)
+        D = self._D_cache.get(key)
+        if D is None:
+            D = _get_D(xp, self._Ann, self.n)
+            if len(self._D_cache) >= _D_CACHE_SIZE:
+                del self._D_cache[next(iter(self._D_cache))]  # evict the oldest entry
+            self._D_cache[key] = D
+
         return D
 
     def y(self, i, j, x, xp=None):
@@ -128,44 +170,64 @@ class Pool:
         """
 
         if xp is None:
-            xx = self.xp()
-        else:
-            xx = xp[:]
-        D = self.D(xx)
-        D = mpz(D)
-        xx[i] = x  # x is quantity of underlying asset brought to 1e18 precision
-        xx = [xx[k] for k in range(self.n) if k != j]
-        Ann = self.A * self.n
+            xp = self.xp()
+        D = self.D(xp)
+        Ann = self._Ann
         c = D
-        for y in xx:
-            c = c * D // (y * self.n)
+        S = 0
+        for k, _x in enumerate(xp):
+            if k == j:
+                continue
+            if k == i:
+                _x = x  # x is quantity of underlying asset brought to 1e18 precision
+            c = c * D // (_x * self.n)
+            S += _x
         c = c * D // (self.n * Ann)
-        b = sum(xx) + D // Ann - D
-        y_prev = 0
-        y = D
-        while abs(y - y_prev) > 1:
-            y_prev = y
-            y = (y**2 + c) // (2 * y + b)
-        y = int(y)
-        return y  # the result is in underlying units too
+        b = S + D // Ann - D
+        return _get_y(c, b, D)  # the result is in underlying units too
+
+    def y_batch(self, i, j, xs):
+        """
+        `y` for each x in xs, with D and the terms of c and b that don't depend on x
+        computed once. The floor divisions for c keep the coin order used by `y`,
+        so each result matches `self.y(i, j, x)` exactly.
+        """
+        xp = self.xp()
+        D = self.D(xp)
+        Ann = self._Ann
+        c_pre = D  # c accumulated over the coins before i
+        nx_post = []  # denominators for the coins after i
+        S = 0
+        for k, _x in enumerate(xp):
+            if k == i or k == j:
+                continue
+            if k < i:
+                c_pre = c_pre * D // (_x * self.n)
+            else:
+                nx_post.append(_x * self.n)
+            S += _x
+        b = S + D // Ann - D
+
+        ys = []
+        for x in xs:
+            x = int(x)
+            c = c_pre * D // (x * self.n)
+            for nx in nx_post:
+                c = c * D // nx
+            c = c * D // (self.n * Ann)
+            ys.append(_get_y(c, b + x, D))
+
+        return ys
 
     def y_underlying(self, i, j, x):
         # For meta-pool
-        rates = self.p[:]
-        rates[self.max_coin] = self.basepool.get_virtual_price()
+        rates = self._rates()
 
         # Use base_i or base_j if they are >= 0
-        base_i = i - self.max_coin
-        base_j = j - self.max_coin
-        meta_i = self.max_coin
-        meta_j = self.max_coin
-        if base_i < 0:
-            meta_i = i
-        if base_j < 0:
-            meta_j = j
+        base_i, base_j, meta_i, meta_j = self._meta_indices(i, j)
 
         if base_i < 0 or base_j < 0:  # if i or j not in basepool
-            xp = [x * p // 10**18 for x, p in zip(self.x, rates)]
+            xp = self.xp(rates=rates)
 
             if base_i >= 0:
                 # i is from BasePool
@@ -200,7 +262,7 @@ class Pool:
 
         return y
 
-    def y_D(self, i, _D):
+    def y_D(self, i, _D, xp=None):
         """
         Calculate x[j] if one makes x[i] = x
 
@@ -210,39 +272,28 @@ class Pool:
 
         x_1 = (x_1**2 + c) / (2*x_1 + b)
         """
-        xx = self.xp()
-        xx = [xx[k] for k in range(self.n) if k != i]
-        S = sum(xx)
-        Ann = self.A * self.n
+        xx = xp or self.xp()
+        Ann = self._Ann
         c = _D
-        for y in xx:
-            c = c * _D // (y * self.n)
+        S = 0
+        for k, _x in enumerate(xx):
+            if k == i:
+                continue
+            c = c * _D // (_x * self.n)
+            S += _x
         c = c * _D // (self.n * Ann)
-        b = S + _D // Ann
-        y_prev = 0
-        y = _D
-        while abs(y - y_prev) > 1:
-            y_prev = y
-            y = (y**2 + c) // (2 * y + b - _D)
-        return y  # the result is in underlying units too
+        b = S + _D // Ann - _D
+        return _get_y(c, b, _D)  # the result is in underlying units too
 
     def dy(self, i, j, dx):
         if self.ismeta:  # note that fees are already included
-            rates = self.p[:]
-            rates[self.max_coin] = self.basepool.get_virtual_price()
+            rates = self._rates()
 
             # Use base_i or base_j if they are >= 0
-            base_i = i - self.max_coin
-            base_j = j - self.max_coin
-            meta_i = self.max_coin
-            meta_j = self.max_coin
-            if base_i < 0:
-                meta_i = i
-            if base_j < 0:
-                meta_j = j
+            base_i, base_j, meta_i, meta_j = self._meta_indices(i, j)
 
             if base_i < 0 or base_j < 0:  # if i or j not in basepool
-                xp = [x * p // 10**18 for x, p in zip(self.x, rates)]
+                xp = self.xp(rates=rates)
 
                 if base_i < 0:
                     x = xp[i] + dx * rates[i] // 10**18
@@ -281,25 +332,17 @@ class Pool:
         else:  # if not meta-pool
             # dx and dy are in underlying units
             xp = self.xp()
-            return xp[j] - self.y(i, j, xp[i] + dx)
+            return xp[j] - self.y(i, j, xp[i] + dx, xp)
 
     def exchange(self, i, j, dx):
         if self.ismeta:  # exchange_underlying
-            rates = self.p[:]
-            rates[self.max_coin] = self.basepool.get_virtual_price()
+            rates = self._rates()
 
             # Use base_i or base_j if they are >= 0
-            base_i = i - self.max_coin
-            base_j = j - self.max_coin
-            meta_i = self.max_coin
-            meta_j = self.max_coin
-            if base_i < 0:
-                meta_i = i
-            if base_j < 0:
-                meta_j = j
+            base_i, base_j, meta_i, meta_j = self._meta_indices(i, j)
 
             if base_i < 0 or base_j < 0:  # if i or j not in basepool
-                xp = [x * p // 10**18 for x, p in zip(self.x, rates)]
+                xp = self.xp(rates=rates)
 
                 if base_i < 0:
                     x = xp[i] + dx * rates[i] // 10**18
@@ -343,39 +386,93 @@ class Pool:
             return dy, dy_fee
 
         else:  # if not meta-pool, normal exchange
-            xp = self.xp()
-            x = xp[i] + dx
-            y = self.y(i, j, x)
-            dy = xp[j] - y
-            if self.feemul is None:  # if not dynamic fee pool
-                fee = dy * self.fee // 10**10
-            else:  # if dynamic fee pool
-                fee = dy * self.dynamic_fee((xp[i] + x) // 2, (xp[j] + y) // 2) // 10**10
-            assert dy > 0
-            self.x[i] = x * 10**18 // self.p[i]
-            self.x[j] = (y + fee) * 10**18 // self.p[j]
-            return dy - fee, fee
+            self.x[i], self.x[j], dy, fee = self._exchange_balances(i, j, dx)
+            return dy, fee
 
-    def remove_liquidity_imbalance(self, amounts):
+    def _exchange_balances(self, i, j, dx):
+        """
+        Regular (non-meta) exchange calculation, without changing the pool state.
+
+        Returns the new balances of coin[i] and coin[j], dy[j] net of fee, and the fee.
+        """
+        xp = self.xp()
+        x = xp[i] + dx
+        y = self.y(i, j, x, xp)
+        dy = xp[j] - y
+        if self.feemul is None:  # if not dynamic fee pool
+            fee = dy * self.fee // 10**10
+        else:  # if dynamic fee pool
+            fee = dy * self.dynamic_fee((xp[i] + x) // 2, (xp[j] + y) // 2) // 10**10
+        assert dy > 0
+        return x * 10**18 // self.p[i], (y + fee) * 10**18 // self.p[j], dy - fee, fee
+
+    @contextmanager
+    def snapshot(self):
+        """
+        Context manager that restores the pool's balances and LP token supply on exit,
+        along with the basepool's for a metapool, even if the block raises.
+
+        Balances are restored into the original lists, so references to `x` taken
+        before the block see the restored values too.
+        """
+        ismeta = self.ismeta
+        x = self.x
+        x_saved = x.copy()
+        tokens = self.tokens
+        if ismeta:
+            bp = self.basepool
+            x_base = bp.x
+            x_base_saved = x_base.copy()
+            tokens_base = bp.tokens
+
+        try:
+            yield self
+        finally:
+            x[:] = x_saved
+            self.x = x
+            self.tokens = tokens
+            if ismeta:
+                x_base[:] = x_base_saved
+                bp.x = x_base
+                bp.tokens = tokens_base
+
+    def _trial_exchange(self, i, j, dx):
+        """
+        Returns dy[j] and the resulting price, dy[j]/dx[i], of an exchange, leaving the pool state unchanged.
+        """
+        if self.ismeta:
+            with self.snapshot():
+                dy, fee = self.exchange(i, j, dx)
+                price = self.dydx(i, j)
+
+        else:
+            # Trade against a scratch copy of the balances instead of the pool itself
+            x = self.x[:]
+            x[i], x[j], dy, fee = self._exchange_balances(i, j, dx)
+            price = self._dydx(i, j, self.xp(x))
+
+        return dy, price
+
+    def _imbalance_D(self, new_balances):
+        """
+        D before and after moving the pool to new_balances, charging the imbalance fee
+        as add_liquidity and remove_liquidity_imbalance do; returns (D0, D2).
+        """
         _fee = self.fee * self.n // (4 * (self.n - 1))
 
-        old_balances = self.x
-        new_balances = self.x[:]
         D0 = self.D()
-        for i in range(self.n):
-            new_balances[i] -= amounts[i]
-        self.x = new_balances
-        D1 = self.D()
-        self.x = old_balances
-        fees = [0] * self.n
-        for i in range(self.n):
-            ideal_balance = D1 * old_balances[i] // D0
-            difference = abs(ideal_balance - new_balances[i])
-            fees[i] = _fee * difference // 10**10
-            new_balances[i] -= fees[i]
-        self.x = new_balances
-        D2 = self.D()
-        self.x = old_balances
+        D1 = self.D(self.xp(new_balances))
+
+        # fees are charged on each balance's difference from its ideal balance, D1 * old // D0
+        fees = [_fee * abs(D1 * old // D0 - new) // 10**10 for old, new in zip(self.x, new_balances)]
+        fee_balances = [new - fee for new, fee in zip(new_balances, fees)]
+        D2 = self.D(self.xp(fee_balances))
+
+        return D0, D2
+
+    def remove_liquidity_imbalance(self, amounts):
+        new_balances = [x - amount for x, amount in zip(self.x, amounts)]
+        D0, D2 = self._imbalance_D(new_balances)
 
         token_amount = (D0 - D2) * self.tokens // D0
 
@@ -388,38 +485,18 @@ class Pool:
         else:
             fee = 0
 
-        D0 = self.D()
+        D0 = self.D(xp)
         D1 = D0 - token_amount * D0 // self.tokens
-        dy = xp[i] - self.y_D(i, D1)
+        dy = xp[i] - self.y_D(i, D1, xp)
 
         return dy - dy * fee // 10**10
 
     def add_liquidity(self, amounts):
-        _fee = self.fee * self.n // (4 * (self.n - 1))
-
-        old_balances = self.x
-        new_balances = self.x[:]
-        D0 = self.D()
-
-        for i in range(self.n):
-            new_balances[i] += amounts[i]
-        self.x = new_balances
-        D1 = self.D()
-        self.x = old_balances
-
-        fees = [0] * self.n
-        mint_balances = new_balances[:]
-        for i in range(self.n):
-            ideal_balance = D1 * old_balances[i] // D0
-            difference = abs(ideal_balance - new_balances[i])
-            fees[i] = _fee * difference // 10**10
-            mint_balances[i] -= fees[i]  # used to calculate mint amount
-
-        self.x = mint_balances
-        D2 = self.D()
-        self.x = new_balances
+        new_balances = [x + amount for x, amount in zip(self.x, amounts)]
+        D0, D2 = self._imbalance_D(new_balances)
 
         mint_amount = self.tokens * (D2 - D0) // D0
+        self.x = new_balances
         self.tokens += mint_amount
 
         return mint_amount
@@ -432,36 +509,23 @@ class Pool:
 
     def calc_token_amount(self, amounts):
         # Based on add_liquidity (more accurate than calc_token_amount in actual contract)
-        _fee = self.fee * self.n // (4 * (self.n - 1))
-
-        old_balances = self.x
-        new_balances = self.x[:]
-        D0 = self.D()
-
-        for i in range(self.n):
-            new_balances[i] += amounts[i]
-        self.x = new_balances
-        D1 = self.D()
-        self.x = old_balances
-
-        fees = [0] * self.n
-        mint_balances = new_balances[:]
-        for i in range(self.n):
-            ideal_balance = D1 * old_balances[i] // D0
-            difference = abs(ideal_balance - new_balances[i])
-            fees[i] = _fee * difference // 10**10
-            mint_balances[i] -= fees[i]  # used to calculate mint amount
-
-        self.x = mint_balances
-        D2 = self.D()
-        self.x = old_balances
+        new_balances = [x + amount for x, amount in zip(self.x, amounts)]
+        D0, D2 = self._imbalance_D(new_balances)
 
         mint_amount = self.tokens * (D2 - D0) // D0
 
         return mint_amount
 
     def get_virtual_price(self):
-        return self.D() * 10**18 // self.tokens
+        """
+        Cached on the pool state, like `D`, since a metapool reads its basepool's
+        virtual price as the LP token rate on every operation.
+        """
+        key = (self._Ann, self.tokens, *self.x, *self.p)
+        if key != self._vp_cache[0]:
+            self._vp_cache = (key, self.D() * 10**18 // self.tokens)
+
+        return self._vp_cache[1]
 
     def dynamic_fee(self, xpi, xpj):
         xps2 = xpi + xpj
@@ -477,6 +541,20 @@ class Pool:
         """
         return self.dydx(i, j, dx, use_fee=True)
 
+    def dydxfee_many(self, pairs):
+        """
+        Returns prices with fee, as `dydxfee`, for each (i, j) in pairs as an array.
+
+        For regular pools the balances are scaled once and shared by all pairs.
+        """
+        if self.ismeta:
+            prices = [self.dydxfee(i, j) for i, j in pairs]
+        else:
+            xp = self.xp()
+            prices = [self._dydx(i, j, xp, use_fee=True) for i, j in pairs]
+
+        return np.array(prices)
+
     def dydx(self, i, j, dx=10**12, use_fee=False):
         """
         Returns price, dy[j]/dx[i], given some dx[i]
@@ -497,23 +575,20 @@ class Pool:
             #
             # D' = -1 * ( A * n ** (n+1) * prod(x_k) + D ** (n+1) / x_i)
             #          / ( n ** n * prod(x_k) - A * n ** (n+1) * prod(x_k) - (n + 1) * D ** n
-            rates = self.p[:]
-            rates[self.max_coin] = self.basepool.get_virtual_price()
-            xp = [mpz(x) * p // 10**18 for x, p in zip(self.x, rates)]
+            rates = self._rates()
+            xp = self.xp(rates=rates)
 
             # Use base_i or base_j if they are >= 0
-            base_i = i - self.max_coin
-            base_j = j - self.max_coin
+            base_i, base_j, meta_i, meta_j = self._meta_indices(i, j)
 
             if base_i < 0 or base_j < 0:  # if i or j not in basepool
                 bp = self.basepool
                 base_xp = [mpz(x) * p // 10**18 for x, p in zip(bp.x, bp.p)]
                 x_prod = prod(base_xp)
                 n = bp.n
-                A = bp.A
                 D = mpz(bp.D())
                 D_pow = D ** (n + 1)
-                A_pow = A * n ** (n + 1)
+                A_pow = bp._A_pow
 
                 if base_i < 0:  # i is primary
                     xj = base_xp[base_j]
@@ -542,8 +617,6 @@ class Pool:
                     dw = dw * rates[self.max_coin] // 10**18
                     x = xp[self.max_coin] + dw
 
-                    meta_i = self.max_coin
-                    meta_j = j
                     y = self.y(meta_i, meta_j, x, xp)
 
                     dy = xp[meta_j] - y - 1
@@ -571,17 +644,14 @@ class Pool:
         Treats indices as applying to the "top-level" pool if a metapool.
         Basically this is the "regular" pricing calc with no special metapool handling.
         """
-        xp = xp or [mpz(x) for x in self.xp()]
+        xp = xp or self.xp()
 
         xi = xp[i]
         xj = xp[j]
-        n = self.n
-        A = self.A
         D = self.D(xp)
-        D_pow = mpz(D) ** (n + 1)
-        x_prod = prod(xp)
-        A_pow = A * n ** (n + 1)
-        dydx = (xj * (xi * A_pow * x_prod + D_pow)) / (xi * (xj * A_pow * x_prod + D_pow))
+        D_pow = D ** (self.n + 1)
+        Ax_prod = self._A_pow * prod(xp)
+        dydx = (xj * (xi * Ax_prod + D_pow)) / (xi * (xj * Ax_prod + D_pow))
 
         if use_fee:
             if self.feemul is None:
@@ -607,42 +677,40 @@ class Pool:
         res: output from numerical estimator
 
         """
+        # The upper bound solves y for a trade leaving 1% of coin[j]. A linear estimate
+        # (coin[j] reserve / dydx) is cheaper to compute but needs more brentq iterations.
         if self.ismeta:
             # Use base_i or base_j if they are >= 0
-            base_i = i - self.max_coin
-            base_j = j - self.max_coin
-            meta_i = self.max_coin
-            meta_j = self.max_coin
-            if base_i < 0:
-                meta_i = i
-            if base_j < 0:
-                meta_j = j
+            base_i, base_j, meta_i, meta_j = self._meta_indices(i, j)
 
             if base_i < 0 or base_j < 0:
-                rates = self.p[:]
-                rates[self.max_coin] = self.basepool.get_virtual_price()
-                xp = [x * p // 10**18 for x, p in zip(self.x, rates)]
+                rates = self._rates()
+                xp = self.xp(rates=rates)
 
                 hi = self.y(meta_j, meta_i, int(xp[meta_j] * 0.01), xp) - self.xp()[meta_i]
             else:
-                hi = (
-                    self.basepool.y(base_j, base_i, int(self.basepool.xp()[base_j] * 0.01))
-                    - self.basepool.xp()[base_i]
-                )
+                base_xp = self.basepool.xp()
+                hi = self.basepool.y(base_j, base_i, int(base_xp[base_j] * 0.01), base_xp) - base_xp[base_i]
 
             bounds = (10**12, hi)
 
         else:
+            xp = self.xp()
             bounds = (
                 10**12,
-                self.y(j, i, int(self.xp()[j] * 0.01)) - self.xp()[i],
+                self.y(j, i, int(xp[j] * 0.01), xp) - xp[i],
             )  # Lo: 1, Hi: enough coin[i] to leave 1% of coin[j]
 
-        res = root_scalar(arberror, args=(self, i, j, p), bracket=bounds, method="brentq")
+        # The metapool upper bound mixes rate- and precision-scaled balances at the LP
+        # token index, so it can fall below the lower bound; report no trade in that case.
+        if bounds[1] <= bounds[0]:
+            return (i, j, 0), arberror(0, self, i, j, p), None
+
+        root, res = brentq(arberror, *bounds, args=(self, i, j, p), full_output=True, disp=False)
 
-        trade = (i, j, int(res.root))
+        trade = (i, j, int(root))
 
-        error = arberror(res.root, self, i, j, p)
+        error = arberror(root, self, i, j, p)
 
         return trade, error, res
 
@@ -661,54 +729,28 @@ class Pool:
         # Initial guesses for dx, limits, and trades
         # uses optarb (i.e., only considering price of coin[i] and coin[j])
         # guess will be too high but in range
-        k = 0
-        x0 = []
-        lo = []
-        hi = []
-        coins = []
-        price_targs = []
-        for pair in combos:
-            i = pair[0]
-            j = pair[1]
-            if arberror(10**12, self, i, j, prices[k]) > 0:
-                try:
-                    trade, error, res = self.optarb(i, j, prices[k])
-                    x0.append(min(trade[2], int(limits[k] * 10**18)))
-                except Exception:
-                    x0.append(0)
-
-                lo.append(0)
-                hi.append(int(limits[k] * 10**18) + 1)
-                coins.append((i, j))
-                price_targs.append(prices[k])
-
-            elif arberror(10**12, self, j, i, 1 / prices[k]) > 0:
-                try:
-                    trade, error, res = self.optarb(j, i, 1 / prices[k])
-                    x0.append(min(trade[2], int(limits[k] * 10**18)))
-                except Exception:
-                    x0.append(0)
-
-                lo.append(0)
-                hi.append(int(limits[k] * 10**18) + 1)
-                coins.append((j, i))
-                price_targs.append(1 / prices[k])
-
+        rows = []  # (x0, lo, hi, coins, price_targs) for each pair
+        for (i, j), price, limit in zip(combos, prices, limits):
+            if arberror(10**12, self, i, j, price) > 0:
+                pair = (i, j)
+            elif arberror(10**12, self, j, i, 1 / price) > 0:
+                pair = (j, i)
+                price = 1 / price
             else:
-                x0.append(0)
-                lo.append(0)
-                hi.append(int(limits[k] * 10**18 + 1))
-                coins.append((i, j))
-                price_targs.append(prices[k])
-            k += 1
+                rows.append((0, 0, int(limit * 10**18 + 1), (i, j), price))
+                continue
+
+            try:
+                trade, error, res = self.optarb(*pair, price)
+                guess = min(trade[2], int(limit * 10**18))
+            except Exception:
+                guess = 0
+
+            rows.append((guess, 0, int(limit * 10**18) + 1, pair, price))
 
         # Order trades in terms of expected size
-        order = sorted(range(len(x0)), reverse=True, key=x0.__getitem__)
-        x0 = [x0[i] for i in order]
-        lo = [lo[i] for i in order]
-        hi = [hi[i] for i in order]
-        coins = [coins[i] for i in order]
-        price_targs = [price_targs[i] for i in order]
+        rows.sort(reverse=True, key=lambda row: row[0])
+        x0, lo, hi, coins, price_targs = [list(col) for col in zip(*rows)]
 
         # Find trades that minimize difference between pool price and external market price
         trades = []
@@ -749,7 +791,7 @@ class Pool:
                 + " prices: "
                 + str(price_targs)
             )
-            errors = np.array(arberrors([0] * len(x0), self, price_targs, coins))
+            errors = arberrors([0] * len(x0), self, price_targs, coins)
             res = []
         return trades, errors, res
 
@@ -816,7 +858,8 @@ class Pool:
 
         return trades_done, volume
 
-    def orderbook(self, i, j, width=0.1, reso=10**23, show=True):  # noqa: C901
+    def orderbook(self, i, j, width=0.1, reso=10**23, show=True):
+        # pandas and matplotlib are imported lazily; only orderbook/bcurve need them
 
         # if j == 'b', get orderbook against basepool token
         p_mult = 1
@@ -836,45 +879,27 @@ class Pool:
         else:
             metaRevert = False
 
-        # Store initial state
-        x0 = self.x[:]
-        if self.ismeta:
-            x0_base = self.basepool.x[:]
-            t0_base = self.basepool.tokens
-
         # Bids
         bids = [(self.dydx(i, j) * p_mult, 0)]  # tuples: price, depth
         size = 0
 
         while bids[-1][0] > bids[0][0] * (1 - width):
             size += reso
-            self.exchange(i, j, size)
-            price = self.dydx(i, j)
+            dy, price = self._trial_exchange(i, j, size)
             bids.append((price * p_mult, size / 10**18))
 
-            # Return to initial state
-            self.x = x0[:]
-            if self.ismeta:
-                self.basepool.x = x0_base[:]
-                self.basepool.tokens = t0_base
-
         # Asks
         asks = [(1 / self.dydx(j, i) * p_mult, 0)]  # tuples: price, depth
         size = 0
 
         while asks[-1][0] < asks[0][0] * (1 + width):
             size += reso
-            dy, fee = self.exchange(j, i, size)
-            price = 1 / self.dydx(j, i)
-            asks.append((price * p_mult, dy / 10**18))
-
-            # Return to initial state
-            self.x = x0[:]
-            if self.ismeta:
-                self.basepool.x = x0_base[:]
-                self.basepool.tokens = t0_base
+            dy, price = self._trial_exchange(j, i, size)
+            asks.append((1 / price * p_mult, dy / 10**18))
 
         # Format DataFrames
+        import pandas as pd
+
         bids = pd.DataFrame(bids, columns=["price", "depth"]).set_index("price")
         asks = pd.DataFrame(asks, columns=["price", "depth"]).set_index("price")
 
@@ -883,6 +908,8 @@ class Pool:
             self.ismeta = True
 
         if show:
+            import matplotlib.pyplot as plt
+
             plt.plot(bids, color="red")
             plt.plot(asks, color="green")
             plt.xlabel("Price")
@@ -900,42 +927,34 @@ class Pool:
             labels = list(range(self.n))
             labels = ["Coin %s" % str(label) for label in labels]
 
-        plt_n = 0
+        if show:
+            import matplotlib.pyplot as plt
+
+            fig, axs = plt.subplots(1, len(combos), constrained_layout=True)
+            axs = np.atleast_1d(axs)
+            xp = self.xp()  # current balances, marked on each curve
+
         xs_out = []
         ys_out = []
-        for combo in combos:
-            i = combo[0]
-            j = combo[1]
+        for plt_n, (i, j) in enumerate(combos):
 
             if xs is None:
                 xs_i = np.linspace(int(self.D() * 0.0001), self.y(j, i, int(self.D() * 0.0001)), 1000).round()
             else:
                 xs_i = xs
 
-            ys_i = []
-            for x in xs_i:
-                ys_i.append(self.y(i, j, int(x)) / 10**18)
+            ys_i = [y / 10**18 for y in self.y_batch(i, j, xs_i)]
 
-            xs_i = xs_i / 10**18
+            xs_i = np.asarray(xs_i, dtype=float) / 10**18
             xs_out.append(xs_i)
             ys_out.append(ys_i)
 
-            xp = self.xp()[:]
-
             if show:
-                if plt_n == 0:
-                    fig, axs = plt.subplots(1, len(combos), constrained_layout=True)
-
-                if len(combos) == 1:
-                    ax = axs
-                else:
-                    ax = axs[plt_n]
-
+                ax = axs[plt_n]
                 ax.plot(xs_i, ys_i, color="black")
                 ax.scatter(xp[i] / 10**18, xp[j] / 10**18, s=40, color="black")
                 ax.set_xlabel(labels[i])
                 ax.set_ylabel(labels[j])
-                plt_n += 1
 
         if show:
             plt.show()
@@ -943,64 +962,96 @@ class Pool:
         return xs_out, ys_out
 
 
-# Error functions for optarb and optarbs
-def arberror(dx, pool, i, j, p):
-    dx = int(dx)
+# Newton iterations for the stableswap invariant
+#
+# Python ints are as fast as mpz for typical pool sizes, where mpz's per-operation
+# overhead dominates; mpz only pays off once the operands grow well past 2**100.
+_MPZ_THRESHOLD = 2**100
 
-    x_old = pool.x[:]
-    if pool.ismeta:
-        x_old_base = pool.basepool.x[:]
-        tokens_old = pool.basepool.tokens
 
-    pool.exchange(i, j, dx)  # do trade
+def _get_D(xp, Ann, n):
+    """
+    Solves for D by Newton's method; see `Pool.D`. As in the pool contracts,
+    the iteration is capped at 255 rounds.
+
+    Operands are converted to mpz up front for large pools, and the n * x_i
+    denominators and the other loop-invariant terms are computed once.
+    """
+    S = sum(xp)
+    if S == 0:
+        return 0
+
+    if S > _MPZ_THRESHOLD:
+        S = mpz(S)
+        Ann = mpz(Ann)
+        xp = [mpz(x) for x in xp]
+    n_xp = [n * x for x in xp]
+    AnnS = Ann * S
+    Ann_1 = Ann - 1
+    n_1 = n + 1
+
+    D = S
+    for _ in range(255):
+        D_P = D
+        for nx in n_xp:
+            D_P = D_P * D // nx
+        Dprev = D
+        D = (AnnS + D_P * n) * D // (Ann_1 * D + n_1 * D_P)
+        if abs(D - Dprev) <= 1:
+            break
+
+    return int(D)
+
+
+def _get_y(c, b, D):
+    """
+    Solves y**2 + b*y = c by Newton's method, starting from y = D and
+    capped at 255 rounds; see `Pool.y` and `Pool.y_D`.
+    """
+    if D > _MPZ_THRESHOLD:
+        c = mpz(c)
+        b = mpz(b)
+        D = mpz(D)
 
-    # Check price error after trade
-    # Error = pool price (dy/dx) - external price (p);
-    error = pool.dydxfee(i, j) - p
+    y = D
+    for _ in range(255):
+        y_prev = y
+        y = (y * y + c) // (2 * y + b)
+        if abs(y - y_prev) <= 1:
+            break
 
-    pool.x = x_old
-    if pool.ismeta:
-        pool.basepool.x = x_old_base
-        pool.basepool.tokens = tokens_old
+    return int(y)
+
+
+# Error functions for optarb and optarbs
+def arberror(dx, pool, i, j, p):
+    dx = 0 if dx != dx else int(dx)  # dx != dx only for NaN
+    if dx <= 0:  # no trade, so the pool is priced as is
+        return pool.dydxfee(i, j) - p
+
+    with pool.snapshot():
+        pool.exchange(i, j, dx)  # do trade
+
+        # Check price error after trade
+        # Error = pool price (dy/dx) - external price (p);
+        error = pool.dydxfee(i, j) - p
 
     return error
 
 
 def arberrors(dxs, pool, price_targs, coins):
-    x_old = pool.x[:]
-    if pool.ismeta:
-        x_old_base = pool.basepool.x[:]
-        tokens_old = pool.basepool.tokens
-
-    # Do each trade
-    k = 0
-    for pair in coins:
-        i = pair[0]
-        j = pair[1]
-
-        if np.isnan(dxs[k]):
-            dx = 0
-        else:
-            dx = int(dxs[k])
-
-        if dx > 0:
+    # Zero out NaN trades in one pass; dxs stay floats since trade sizes can exceed int64
+    dxs = np.where(np.isnan(dxs), 0, dxs).tolist()
+    trades = [(i, j, int(dx)) for (i, j), dx in zip(coins, dxs) if int(dx) > 0]
+    if not trades:  # the pool is priced as is
+        return pool.dydxfee_many(coins) - price_targs
+
+    with pool.snapshot():
+        # Do each trade
+        for i, j, dx in trades:
             pool.exchange(i, j, dx)
 
-        k += 1
-
-    # Check price errors after all trades
-    errors = []
-    k = 0
-    for pair in coins:
-        i = pair[0]
-        j = pair[1]
-        p = price_targs[k]
-        errors.append(pool.dydxfee(i, j) - p)
-        k += 1
-
-    pool.x = x_old
-    if pool.ismeta:
-        pool.basepool.x = x_old_base
-        pool.basepool.tokens = tokens_old
+        # Check price errors after all trades
+        errors = pool.dydxfee_many(coins) - price_targs
 
     return errors
@@ -1,11 +1,49 @@
 import os
 import pickle
+from itertools import combinations
 
 import numpy as np
 
 import curvesim
+from curvesim.pool import Pool
+
+
+def check_optarb_empty_bracket():
+    """
+    Metapool state where optarb's upper bound for selling a basepool coin into the
+    primary coin falls below its 1e12 lower bound (basepool virtual price ~0.34).
+    optarb must report a zero trade there, and optarbs must still arbitrage the
+    remaining pairs without returning a negative trade.
+    """
+    pool = Pool(
+        [1000, 2000],
+        [760404616722434347001470321, 819982619013633682388932491],
+        [2, 3],
+        tokens=802355790605490742859377556,
+        fee=[4 * 10**6, 3 * 10**6],
+    )
+    pool.x = [1598667279016097923531992, 66623179445012899022677104]
+    pool.basepool.tokens *= 3
+
+    combos = list(combinations(range(pool.n_total), 2))
+    prices = [pool.dydxfee(i, j) * (1.01 if i == 0 else 0.995) for i, j in combos]
+    x_before = pool.x[:]
+
+    for i in range(1, pool.n_total):
+        trade, error, res = pool.optarb(i, 0, 1 / prices[i - 1])
+        if trade != (i, 0, 0):
+            raise AssertionError(f"Expected no trade for empty optarb bracket, got: {trade}")
+
+    trades, errors, res = pool.optarbs(prices, [1e7] * len(combos))
+    if not trades or any(dx <= 0 for i, j, dx in trades):
+        raise AssertionError(f"Unexpected optarbs trades for empty optarb bracket: {trades}")
+    if pool.x != x_before:
+        raise AssertionError("optarb/optarbs changed the pool balances")
+
 
 if __name__ == "__main__":  # noqa: C901
+    check_optarb_empty_bracket()
+
     data_dir = os.path.join("test", "data")
     pool_names = ["3pool", "aave", "frax", "mim"]
 